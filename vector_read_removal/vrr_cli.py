@@ -46,13 +46,56 @@ def parse_args(argv: Optional[list] = None) -> argparse.Namespace:
         default=None,
         help="Extra arguments to pass to minimap2 (quoted string)",
     )
-    opt.add_argument("--tmp-dir", default=None, help="Temporary directory to use")
+    opt.add_argument(
+        "--sam-hit-only",
+        action="store_true",
+        help=(
+            "Have minimap2 leave unmapped reads out of its SAM output (faster; the SAM "
+            "record count then covers alignments only)"
+        ),
+    )
+    opt.add_argument(
+        "--keep-secondary",
+        action="store_true",
+        help="Also consider secondary alignments (passes --secondary=yes; -x sr omits them)",
+    )
+    opt.add_argument(
+        "--mm2-batch-size",
+        default="200M",
+        help=(
+            "minimap2 -K mini-batch size (query bases per batch); pass an empty string for "
+            "minimap2's own default"
+        ),
+    )
+    opt.add_argument(
+        "--no-index-cache",
+        action="store_true",
+        help="Do not build or reuse a cached <ref>.sr.mmi minimap2 index next to the reference",
+    )
+    opt.add_argument(
+        "--sort-by-length",
+        action="store_true",
+        help=(
+            "Feed read pairs to minimap2 longest first to even out its thread load "
+            "(stages sorted copies of the inputs in --tmp-dir)"
+        ),
+    )
+    opt.add_argument(
+        "--tmp-dir",
+        default=None,
+        help="Temporary directory for --sort-by-length copies (default: system temp dir)",
+    )
     opt.add_argument(
         "--gzip-output",
         action="store_true",
         help="Write outputs as .fastq.gz (default writes uncompressed .fastq)",
     )
-    opt.add_argument("--gzip-level", type=int, default=6, help="Compression level for outputs")
+    opt.add_argument("--gzip-level", type=int, default=1, help="Compression level for outputs")
+    opt.add_argument(
+        "--bgzf",
+        action="store_true",
+        help="Write BGZF-framed .fastq.gz outputs with bgzip (htslib); implies --gzip-output",
+    )
     opt.add_argument(
         "--log",
         default=None,
@@ -119,9 +162,15 @@ def main(argv: Optional[list] = None) -> int:
             threads=args.threads,
             minimap2=args.minimap2,
             extra_mm2_args=args.extra_mm2_args,
+            mm2_secondary=args.keep_secondary,
+            mm2_batch_size=args.mm2_batch_size,
+            mm2_hits_only=args.sam_hit_only,
+            sort_by_length=args.sort_by_length,
+            cache_index=not args.no_index_cache,
             tmp_dir=args.tmp_dir,
             gzip_output=args.gzip_output,
             gzip_level=args.gzip_level,
+            bgzf=args.bgzf,
             logger=logging.getLogger("vector_read_removal"),
         )
     except Exception as e:
@@ -131,11 +180,13 @@ def main(argv: Optional[list] = None) -> int:
     logger.info("Output R1: %s", out_r1)
     logger.info("Output R2: %s", out_r2)
     logger.info(
-        "Stats: total_pairs=%d kept=%d dropped=%d nm_threshold=%d runtime_sec=%.3f",
+        "Stats: total_pairs=%d kept=%d dropped=%d nm_threshold=%d "
+        "sam_records=%d runtime_sec=%.3f",
         stats.get("total_pairs", 0),
         stats.get("kept_pairs", 0),
         stats.get("dropped_pairs", 0),
         stats.get("nm_threshold", 0),
+        stats.get("total_sam_records", 0),
         stats.get("runtime_sec", 0.0),
     )
 
@@ -1,21 +1,64 @@
 import csv
-import gzip
+import hashlib
+import io
+import itertools
 import contextlib
 import logging
+import mmap
+import operator
 import os
+import queue
 import shlex
 import shutil
+import signal
 import subprocess
 import tempfile
+import threading
 import time
+from array import array
 from collections import Counter
-from typing import Dict, Optional, Tuple, Union
-
-import pysam
+from typing import (
+    IO,
+    AbstractSet,
+    Callable,
+    ContextManager,
+    Dict,
+    FrozenSet,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+    Union,
+)
+
+from xopen import xopen
 
 
 StatsDict = Dict[str, Union[int, float, str]]
 
+# SAM FLAG bits consulted while scanning minimap2 output
+_FLAG_UNMAPPED = 0x4
+_FLAG_READ1 = 0x40
+_FLAG_READ2 = 0x80
+_FLAG_SECONDARY = 0x100
+_FLAG_SUPPLEMENTARY = 0x800
+
+# Write buffer for FASTQ outputs, so kept records reach the file in few large writes
+_OUTPUT_BUFFER_SIZE = 1 << 20
+
+# Read size for FASTQ inputs; records are sliced out of each chunk
+_INPUT_CHUNK_SIZE = 4 << 20
+
+# Pairs per batch handed between the output pipeline's threads, and batches buffered
+# between each pair of stages
+_PAIR_BATCH_SIZE = 10000
+_PIPELINE_QUEUE_SIZE = 8
+
+# Batches between DEBUG progress messages in the output pass (1M pairs)
+_PROGRESS_BATCHES = 100
+
 
 def _check_minimap2(minimap2: str) -> str:
     """Return the resolved path to minimap2 or raise if not found."""
@@ -27,6 +70,93 @@ def _check_minimap2(minimap2: str) -> str:
     return path
 
 
+def _collect_stderr(stream: IO[bytes], name: str) -> Tuple[threading.Thread, List[bytes]]:
+    """Drain a child's stderr on a background thread so it never blocks on a full pipe."""
+    chunks: List[bytes] = []
+
+    def _drain() -> None:
+        for chunk in iter(lambda: stream.read(65536), b""):
+            chunks.append(chunk)
+
+    thread = threading.Thread(target=_drain, name=f"{name}-stderr", daemon=True)
+    thread.start()
+    return thread, chunks
+
+
+def _cached_index(
+    ref_fasta: str,
+    minimap2: str,
+    extra_mm2_args: Optional[str],
+    threads: int,
+    logger: logging.Logger,
+) -> str:
+    """
+    Return the path to a cached minimap2 sr index of ref_fasta, building it if needed.
+
+    The index lives next to the FASTA as <ref_fasta>.sr.mmi (with a digest of extra_mm2_args
+    in the name when given, since they may change indexing options) and is rebuilt when
+    missing or older than the FASTA. If the directory is not writable, or an up-to-date
+    index exists but is not readable, ref_fasta is returned and minimap2 indexes it in
+    memory as before.
+    """
+    if ref_fasta.endswith(".mmi"):
+        return ref_fasta
+    suffix = ".sr.mmi"
+    if extra_mm2_args:
+        digest = hashlib.sha1(extra_mm2_args.encode("utf-8")).hexdigest()[:8]
+        suffix = f".sr.{digest}.mmi"
+    idx_path = ref_fasta + suffix
+    try:
+        if os.path.getmtime(idx_path) >= os.path.getmtime(ref_fasta):
+            if os.access(idx_path, os.R_OK):
+                logger.info("Using cached minimap2 index: %s", idx_path)
+                return idx_path
+            logger.warning(
+                "Cached minimap2 index %s is not readable; indexing %s in memory",
+                idx_path,
+                ref_fasta,
+            )
+            return ref_fasta
+    except OSError:
+        pass
+
+    try:
+        fd, tmp_path = tempfile.mkstemp(
+            prefix=os.path.basename(idx_path) + ".", dir=os.path.dirname(idx_path) or "."
+        )
+    except OSError as e:
+        logger.warning(
+            "Cannot cache minimap2 index next to %s (%s); indexing in memory", ref_fasta, e
+        )
+        return ref_fasta
+    os.close(fd)
+
+    cmd = [_check_minimap2(minimap2), "-x", "sr", "-t", str(threads)]
+    if extra_mm2_args:
+        cmd.extend(shlex.split(extra_mm2_args))
+    cmd.extend(["-d", tmp_path, ref_fasta])
+    logger.info("Building minimap2 index: %s", " ".join(shlex.quote(c) for c in cmd))
+    try:
+        result = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        if result.returncode != 0:
+            stderr = result.stderr.decode("utf-8", errors="replace")
+            raise RuntimeError(
+                f"minimap2 index build failed with code {result.returncode}:\n{stderr}"
+            )
+        # mkstemp creates the file as 0600; give the index the usual umask-based mode so
+        # other users of a shared reference directory can read it
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(tmp_path, 0o666 & ~umask)
+        # Built under a temporary name so concurrent runs never see a partial index
+        os.replace(tmp_path, idx_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return idx_path
+
+
+@contextlib.contextmanager
 def _run_minimap2(
     r1_path: str,
     r2_path: str,
@@ -34,28 +164,559 @@ def _run_minimap2(
     threads: int,
     minimap2: str,
     extra_mm2_args: Optional[str],
-    sam_out_path: str,
     logger: logging.Logger,
-) -> None:
+    pass_fds: Sequence[int] = (),
+    secondary: bool = False,
+    batch_size: Optional[str] = "200M",
+    hits_only: bool = False,
+) -> Iterator[IO[bytes]]:
+    """
+    Start minimap2 and yield its SAM output stream.
+
+    The alignment runs concurrently with whatever consumes the stream; on exit the process
+    is reaped and a RuntimeError is raised if it failed. pass_fds are inherited by minimap2
+    so inputs may be given as /dev/fd/N paths.
+
+    With hits_only, unmapped reads are left out of the SAM (--sam-hit-only; the filter keeps
+    them anyway). The sr preset already suppresses secondary alignments, so secondary=True
+    passes --secondary=yes to report them. batch_size is passed as -K, the number of query
+    bases loaded per mini-batch. extra_mm2_args come last, so they can override these.
+    """
     mm2_path = _check_minimap2(minimap2)
 
     cmd = [mm2_path, "-a", "-x", "sr", "-t", str(threads)]
+    if hits_only:
+        cmd.append("--sam-hit-only")
+    if secondary:
+        cmd.append("--secondary=yes")
+    if batch_size:
+        cmd.extend(["-K", batch_size])
     if extra_mm2_args:
         cmd.extend(shlex.split(extra_mm2_args))
     cmd.extend([ref_fasta, r1_path, r2_path])
 
     logger.info("Running minimap2: %s", " ".join(shlex.quote(c) for c in cmd))
 
-    with open(sam_out_path, "wb") as sam_fh:
-        proc = subprocess.run(
+    proc = subprocess.Popen(
+        cmd,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        bufsize=1 << 20,
+        pass_fds=pass_fds,
+    )
+    stderr_thread, stderr_chunks = _collect_stderr(proc.stderr, "minimap2")
+    consumer_failed = False
+    try:
+        yield proc.stdout
+    except BaseException:
+        consumer_failed = True
+        raise
+    finally:
+        proc.stdout.close()
+        stopped_by_us = False
+        if consumer_failed:
+            # Give minimap2 a moment to exit on its own (its own failure is usually why the
+            # consumer stopped); otherwise stop it.
+            try:
+                proc.wait(timeout=1)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+                stopped_by_us = True
+        returncode = proc.wait()
+        stderr_thread.join()
+        proc.stderr.close()
+        # If the consumer failed and minimap2 merely died from losing its reader, let the
+        # original exception propagate instead. Behind a shell wrapper (conda, modules) the
+        # SIGPIPE death surfaces as exit code 128 + SIGPIPE rather than -SIGPIPE.
+        lost_reader = consumer_failed and (
+            stopped_by_us or returncode in (-signal.SIGPIPE, 128 + signal.SIGPIPE)
+        )
+        if returncode != 0 and not lost_reader:
+            stderr = b"".join(stderr_chunks).decode("utf-8", errors="replace")
+            raise RuntimeError(f"minimap2 failed with code {returncode}:\n{stderr}")
+
+
+def _scan_sam(
+    sam_stream: IO[bytes], nm_threshold: int
+) -> Tuple[FrozenSet[bytes], Counter[str], int]:
+    """
+    Scan minimap2 SAM output for reads to drop.
+
+    A mate is dropped as soon as any of its alignments is within the NM threshold
+    (equivalent to its minimal NM being within it), so only the names to drop are
+    retained. A pair is dropped if either mate is, so R1 and R2 hits share one set.
+
+    Only QNAME, FLAG, RNAME and the NM tag are needed, so the SAM text is split directly
+    rather than building a full alignment record per line. Just the leading fields are
+    split off first, so unmapped records (usually the bulk of the stream, unless minimap2
+    was run with --sam-hit-only) are rejected before the rest of the line is looked at.
+
+    Returns (drop_names, primary_counts_by_reference, total_sam_records), where
+    total_sam_records counts the non-header records in the stream.
+    """
+    drop_any: Set[bytes] = set()
+    primary_counts: Counter[bytes] = Counter()
+    header_lines = 0
+    line_no = 0
+    # The loop runs once per SAM record, so the names it uses are bound to locals up front
+    # rather than looked up as globals/attributes on every iteration
+    drop_add = drop_any.add
+    threshold = nm_threshold
+    unmapped = _FLAG_UNMAPPED
+    not_primary = _FLAG_SECONDARY | _FLAG_SUPPLEMENTARY
+    mate_flags = _FLAG_READ1 | _FLAG_READ2
+    to_int = int
+    # Lines are counted by enumerate and the (few) header lines subtracted at the end,
+    # which keeps a per-record increment out of the loop
+    for line_no, line in enumerate(sam_stream, 1):
+        if line[0] == 64:  # b"@" header line
+            header_lines += 1
+            continue
+        qname, flag_field, ref_name, rest = line.split(b"\t", 3)
+        flag = to_int(flag_field)
+        if flag & unmapped:
+            continue
+        if not flag & not_primary:
+            if ref_name != b"*":
+                primary_counts[ref_name] += 1
+        # Locate the NM tag with bytes.rfind rather than splitting out SEQ, QUAL and every
+        # tag: the C search starts from the end of the line, where the tags are, and stops
+        # within a few dozen bytes. minimap2 writes NM on every mapped record, so the last
+        # match is the tag itself.
+        pos = rest.rfind(b"\tNM:i:")
+        if pos < 0:
+            # No NM tag present; skip from drop consideration
+            continue
+        end = rest.find(b"\t", pos + 6)
+        nm = to_int(rest[pos + 6:end] if end >= 0 else rest[pos + 6:])
+        if nm > threshold:
+            continue
+        if not flag & mate_flags:
+            # In rare cases, orientation flags might not indicate read1/read2; ignore
+            continue
+        drop_add(qname)
+    total_sam_records = line_no - header_lines
+    ref_counts = Counter({name.decode(): count for name, count in primary_counts.items()})
+    # Frozen so the threads of the output pass share an immutable set. This costs one O(n)
+    # copy: the drop set's memory briefly doubles until the mutable set is freed.
+    return frozenset(drop_any), ref_counts, total_sam_records
+
+
+def _find_gzip_decompressor() -> Optional[str]:
+    """Return the path to igzip or pigz (in that order of preference), or None."""
+    for tool in ("igzip", "pigz"):
+        path = shutil.which(tool)
+        if path is not None:
+            return path
+    return None
+
+
+@contextlib.contextmanager
+def _decompress_pipe(decompressor: str, path: str) -> Iterator[IO[bytes]]:
+    """
+    Yield a pipe carrying the decompressed contents of the gzipped file at path.
+
+    Decompression runs in a child process, off the reader's core. The pipe can be handed
+    to another process as /dev/fd/N; consumers must be closed before this context exits.
+    """
+    proc = subprocess.Popen(
+        [decompressor, "-dc", path],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    )
+    name = os.path.basename(decompressor)
+    stderr_thread, stderr_chunks = _collect_stderr(proc.stderr, name)
+    try:
+        yield proc.stdout
+    finally:
+        proc.stdout.close()
+        returncode = proc.wait()
+        stderr_thread.join()
+        proc.stderr.close()
+        # SIGPIPE just means the reader stopped early (e.g. the mate file ran out first);
+        # behind a shell wrapper it surfaces as exit code 128 + SIGPIPE
+        if returncode not in (0, -signal.SIGPIPE, 128 + signal.SIGPIPE):
+            stderr = b"".join(stderr_chunks).decode("utf-8", errors="replace")
+            raise RuntimeError(f"{name} failed on {path} with code {returncode}:\n{stderr}")
+
+
+def _open_inputs(
+    stack: contextlib.ExitStack, paths: Sequence[str], decompressor: Optional[str]
+) -> Tuple[List[str], List[IO[bytes]]]:
+    """
+    Return paths to read the given FASTQs from, plus any decompression pipes opened.
+
+    Gzipped inputs are routed through _decompress_pipe when a decompressor is available
+    and read via /dev/fd/N; other inputs are returned unchanged. The pipes are registered
+    on stack, and the caller may close them once every reader holds its own descriptor.
+    """
+    read_paths: List[str] = []
+    pipes: List[IO[bytes]] = []
+    for path in paths:
+        if decompressor is None or not path.endswith(".gz"):
+            read_paths.append(path)
+            continue
+        pipe = stack.enter_context(_decompress_pipe(decompressor, path))
+        read_paths.append(f"/dev/fd/{pipe.fileno()}")
+        pipes.append(pipe)
+    return read_paths, pipes
+
+
+@contextlib.contextmanager
+def _compressor_writer(cmd: List[str], path: str) -> Iterator[IO[bytes]]:
+    """Yield a stream whose bytes are compressed into path by a child (pigz/bgzip) process."""
+    name = os.path.basename(cmd[0])
+    with open(path, "wb") as out_fh:
+        proc = subprocess.Popen(
             cmd,
-            stdout=sam_fh,
+            stdin=subprocess.PIPE,
+            stdout=out_fh,
             stderr=subprocess.PIPE,
-            check=False,
+            bufsize=_OUTPUT_BUFFER_SIZE,
+        )
+        try:
+            yield proc.stdin
+        finally:
+            try:
+                proc.stdin.close()
+            finally:
+                stderr = proc.stderr.read()
+                proc.stderr.close()
+                returncode = proc.wait()
+                # Raised even while unwinding: a dead compressor surfaces as a
+                # BrokenPipeError in the writer, and its own message is the useful one.
+                if returncode != 0:
+                    message = stderr.decode("utf-8", errors="replace")
+                    raise RuntimeError(f"{name} failed with code {returncode}:\n{message}")
+
+
+def _open_output(
+    path: str,
+    gzip_output: bool,
+    gzip_level: int,
+    threads: int = 1,
+    bgzip: Optional[str] = None,
+) -> ContextManager[IO[bytes]]:
+    """
+    Open a FASTQ output for binary writing behind a large write buffer.
+
+    Given a bgzip executable, gzip output is BGZF-framed by bgzip, run with -@ threads.
+    Otherwise, with threads > 1 and pigz on PATH, it is compressed by pigz; failing that it
+    goes through xopen, which picks the fastest available backend (ISA-L, zlib-ng, pigz)
+    and compresses off the calling thread.
+    """
+    if gzip_output:
+        if bgzip is not None:
+            return _compressor_writer(
+                [bgzip, "-c", "-l", str(gzip_level), "-@", str(threads)], path
+            )
+        pigz = shutil.which("pigz") if threads > 1 else None
+        if pigz is not None:
+            return _compressor_writer([pigz, "-c", f"-{gzip_level}", "-p", str(threads)], path)
+        return io.BufferedWriter(
+            xopen(path, mode="wb", compresslevel=gzip_level, threads=1),
+            buffer_size=_OUTPUT_BUFFER_SIZE,
         )
-    if proc.returncode != 0:
-        stderr = proc.stderr.decode("utf-8", errors="replace")
-        raise RuntimeError(f"minimap2 failed with code {proc.returncode}:\n{stderr}")
+    return open(path, "wb", buffering=_OUTPUT_BUFFER_SIZE)
+
+
+def _open_fastq(
+    stack: contextlib.ExitStack, path: str, decompressor: Optional[str]
+) -> IO[bytes]:
+    """Open a FASTQ input for binary reading, decompressing .gz in a child process if possible."""
+    if decompressor is not None and path.endswith(".gz"):
+        return stack.enter_context(_decompress_pipe(decompressor, path))
+    return stack.enter_context(xopen(path, "rb"))
+
+
+def _iter_fastq_chunks(fh: IO[bytes]) -> Iterator[Tuple[List[bytes], List[memoryview]]]:
+    """
+    Yield (names, records) for the FASTQ records parsed from each chunk read from fh.
+
+    Each record is the raw four-line record, header comment included, exactly as it appears
+    in the input (a missing final newline is added). Input is read in large chunks and the
+    records are zero-copy views into them, ready to be written out unchanged.
+    """
+    tail = b""
+    while True:
+        chunk = fh.read(_INPUT_CHUNK_SIZE)
+        if chunk:
+            buf = tail + chunk if tail else chunk
+        elif tail.strip():
+            buf = tail if tail.endswith(b"\n") else tail + b"\n"
+        else:
+            return
+        find = buf.find
+        view = memoryview(buf)
+        names: List[bytes] = []
+        records: List[memoryview] = []
+        add_name = names.append
+        add_record = records.append
+        start = 0
+        while True:
+            if buf[start:start + 1] == b"\n":
+                # Tolerate blank lines between records
+                start += 1
+                continue
+            header_end = find(b"\n", start)
+            if header_end < 0:
+                break
+            seq_end = find(b"\n", header_end + 1)
+            if seq_end < 0:
+                break
+            plus_end = find(b"\n", seq_end + 1)
+            if plus_end < 0:
+                break
+            qual_end = find(b"\n", plus_end + 1)
+            if qual_end < 0:
+                break
+            # The name runs up to the first whitespace; "@" followed by whitespace or nothing
+            # has no name
+            if buf[start] != 64 or buf[start + 1:start + 2].isspace() or start + 1 == header_end:
+                raise ValueError(f"Malformed FASTQ record: {buf[start:header_end][:80]!r}")
+            add_name(buf[start + 1:header_end].split(None, 1)[0])
+            add_record(view[start:qual_end + 1])
+            start = qual_end + 1
+        if names:
+            yield names, records
+        tail = buf[start:]
+        if not chunk:
+            if tail.strip():
+                raise ValueError(f"Truncated FASTQ record at end of input: {tail[:80]!r}")
+            return
+
+
+def _iter_fastq_batches(
+    fh: IO[bytes], size: int
+) -> Iterator[Tuple[List[bytes], List[memoryview]]]:
+    """Regroup _iter_fastq_chunks output into (names, records) batches of size records."""
+    names: List[bytes] = []
+    records: List[memoryview] = []
+    for chunk_names, chunk_records in _iter_fastq_chunks(fh):
+        names += chunk_names
+        records += chunk_records
+        while len(names) >= size:
+            yield names[:size], records[:size]
+            del names[:size]
+            del records[:size]
+    if names:
+        yield names, records
+
+
+def _sort_pairs_by_length(
+    r1_path: str,
+    r2_path: str,
+    decompressor: Optional[str],
+    work_dir: str,
+    logger: logging.Logger,
+) -> Tuple[str, str]:
+    """
+    Write copies of R1/R2 into work_dir with pairs ordered longest first; return their paths.
+
+    Pairs are ranked by the combined size of their two records, which tracks read length.
+    Both inputs are first spooled uncompressed into work_dir while record offsets are
+    indexed. Record sizes span a narrow range, so the pairs are then bucket-sorted by size
+    (ties keep their input order). Memory holds the offsets and the buckets, about 24 bytes
+    per pair, not the reads.
+    """
+    spools = (
+        os.path.join(work_dir, "r1.spool.fastq"),
+        os.path.join(work_dir, "r2.spool.fastq"),
+    )
+    offsets1 = array("Q", [0])
+    offsets2 = array("Q", [0])
+    with contextlib.ExitStack() as stack:
+        fh1 = _open_fastq(stack, r1_path, decompressor)
+        fh2 = _open_fastq(stack, r2_path, decompressor)
+        w1 = stack.enter_context(open(spools[0], "wb", buffering=_OUTPUT_BUFFER_SIZE))
+        w2 = stack.enter_context(open(spools[1], "wb", buffering=_OUTPUT_BUFFER_SIZE))
+        for (names1, recs1), (names2, recs2) in zip(
+            _iter_fastq_batches(fh1, _PAIR_BATCH_SIZE), _iter_fastq_batches(fh2, _PAIR_BATCH_SIZE)
+        ):
+            n = min(len(recs1), len(recs2))
+            if n < len(recs1):
+                del recs1[n:]
+            if n < len(recs2):
+                del recs2[n:]
+            for offsets, recs in ((offsets1, recs1), (offsets2, recs2)):
+                ends = itertools.accumulate(map(len, recs), initial=offsets[-1])
+                next(ends)  # the initial value, already stored
+                offsets.extend(ends)
+            w1.write(b"".join(recs1))
+            w2.write(b"".join(recs2))
+
+    # One array of pair indices per distinct pair size, filled in input order
+    n_pairs = len(offsets1) - 1
+    pair_sizes = map(
+        operator.sub,
+        map(operator.add, itertools.islice(offsets1, 1, None), itertools.islice(offsets2, 1, None)),
+        map(operator.add, offsets1, offsets2),
+    )
+    buckets: Dict[int, array] = {}
+    for i, size in enumerate(pair_sizes):
+        bucket = buckets.get(size)
+        if bucket is None:
+            bucket = buckets[size] = array("Q")
+        bucket.append(i)
+    sizes_longest_first = sorted(buckets, reverse=True)
+
+    sorted_paths = (
+        os.path.join(work_dir, "r1.sorted.fastq"),
+        os.path.join(work_dir, "r2.sorted.fastq"),
+    )
+    for spool, offsets, out_path in zip(spools, (offsets1, offsets2), sorted_paths):
+        with open(spool, "rb") as fh, open(out_path, "wb", buffering=_OUTPUT_BUFFER_SIZE) as out:
+            if n_pairs:
+                with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    for size in sizes_longest_first:
+                        bucket = buckets[size]
+                        for i in range(0, len(bucket), _PAIR_BATCH_SIZE):
+                            out.write(b"".join([
+                                mm[offsets[j]:offsets[j + 1]]
+                                for j in bucket[i:i + _PAIR_BATCH_SIZE]
+                            ]))
+        os.remove(spool)
+    logger.info("Sorted %d pairs longest-first for minimap2", n_pairs)
+    return sorted_paths
+
+
+def _select_kept(
+    names1: Sequence[bytes],
+    recs1: Sequence[memoryview],
+    names2: Sequence[bytes],
+    recs2: Sequence[memoryview],
+    drop_any: AbstractSet[bytes],
+) -> Tuple[bytes, bytes, int]:
+    """
+    Return the joined R1 and R2 records of the pairs to keep, and their count.
+
+    A pair is kept only if neither mate is in drop_any (i.e., it is dropped if either mate
+    aligns within the NM threshold). Membership is tested for the whole batch with map()
+    over the set's __contains__ and the records are picked with itertools.compress, so no
+    Python bytecode runs per pair.
+    """
+    if not drop_any:
+        return b"".join(recs1), b"".join(recs2), len(recs1)
+    contains = drop_any.__contains__
+    if names1 == names2:
+        # Mates of a synchronized pair share a name, so one lookup per pair suffices
+        keep = list(map(operator.not_, map(contains, names1)))
+    else:
+        keep = list(
+            map(operator.not_, map(operator.or_, map(contains, names1), map(contains, names2)))
+        )
+    out1 = b"".join(itertools.compress(recs1, keep))
+    out2 = b"".join(itertools.compress(recs2, keep))
+    return out1, out2, sum(keep)
+
+
+def _filter_pairs(
+    fh1: IO[bytes],
+    fh2: IO[bytes],
+    drop_any: AbstractSet[bytes],
+    w1: IO[bytes],
+    w2: IO[bytes],
+    logger: Optional[logging.Logger] = None,
+) -> Tuple[int, int]:
+    """
+    Copy the pairs from (fh1, fh2) whose mates are both absent from drop_any to (w1, w2).
+
+    Runs as a three-stage pipeline: a reader thread parses both inputs into batches of
+    pairs, a filter thread tests them against drop_any and joins the kept records, and the
+    calling thread writes them. Bounded queues connect the stages, so decompression,
+    filtering and compression overlap wherever they release the GIL.
+
+    Counts are kept per batch, and progress is logged at DEBUG level every
+    _PROGRESS_BATCHES batches.
+
+    Returns (total_pairs, kept_pairs).
+    """
+    stop = threading.Event()
+    errors: List[BaseException] = []
+    pair_batches: "queue.Queue[Optional[tuple]]" = queue.Queue(maxsize=_PIPELINE_QUEUE_SIZE)
+    kept_batches: "queue.Queue[Optional[Tuple[bytes, bytes]]]" = queue.Queue(
+        maxsize=_PIPELINE_QUEUE_SIZE
+    )
+    counts = {"total": 0, "kept": 0, "batches": 0}
+
+    def _put(q: queue.Queue, item: object) -> bool:
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _get(q: queue.Queue) -> object:
+        while True:
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                if stop.is_set():
+                    return None
+
+    def _stage(target: Callable[[], None], downstream: queue.Queue) -> None:
+        try:
+            target()
+        except BaseException as e:
+            errors.append(e)
+            stop.set()
+        finally:
+            # None marks the end of the stream for the next stage
+            _put(downstream, None)
+
+    def _read() -> None:
+        batches1 = _iter_fastq_batches(fh1, _PAIR_BATCH_SIZE)
+        batches2 = _iter_fastq_batches(fh2, _PAIR_BATCH_SIZE)
+        for (names1, recs1), (names2, recs2) in zip(batches1, batches2):
+            # Like zipping the records, stop at the end of the shorter input
+            n = min(len(names1), len(names2))
+            batch = (names1[:n], recs1[:n], names2[:n], recs2[:n])
+            if not _put(pair_batches, batch) or n < _PAIR_BATCH_SIZE:
+                return
+
+    def _filter() -> None:
+        while True:
+            batch = _get(pair_batches)
+            if batch is None:
+                return
+            out1, out2, kept = _select_kept(*batch, drop_any)
+            counts["total"] += len(batch[0])
+            counts["kept"] += kept
+            counts["batches"] += 1
+            if logger is not None and not counts["batches"] % _PROGRESS_BATCHES:
+                logger.debug("Filtered %d pairs (kept %d)", counts["total"], counts["kept"])
+            if not _put(kept_batches, (out1, out2)):
+                return
+
+    workers = [
+        threading.Thread(
+            target=_stage, args=(_read, pair_batches), name="vrr-fastq-reader", daemon=True
+        ),
+        threading.Thread(
+            target=_stage, args=(_filter, kept_batches), name="vrr-pair-filter", daemon=True
+        ),
+    ]
+    for worker in workers:
+        worker.start()
+    try:
+        while True:
+            kept = _get(kept_batches)
+            if kept is None:
+                break
+            out1, out2 = kept
+            w1.write(out1)
+            w2.write(out2)
+    except BaseException:
+        stop.set()
+        raise
+    finally:
+        for worker in workers:
+            worker.join()
+    if errors:
+        raise errors[0]
+    return counts["total"], counts["kept"]
 
 
 def run_filter(
@@ -69,14 +730,26 @@ def run_filter(
     extra_mm2_args: Optional[str] = None,
     tmp_dir: Optional[str] = None,
     gzip_output: bool = False,
-    gzip_level: int = 6,
+    gzip_level: int = 1,
     logger: Optional[logging.Logger] = None,
+    *,
+    mm2_secondary: bool = False,
+    mm2_batch_size: Optional[str] = "200M",
+    mm2_hits_only: bool = False,
+    sort_by_length: bool = False,
+    cache_index: bool = True,
+    bgzf: bool = False,
 ) -> Tuple[str, str, StatsDict]:
     """
     Align paired FASTQ reads against a reference with minimap2 and keep pairs that do not
     align within the NM edit distance threshold.
 
-    Returns (out_r1_path, out_r2_path, stats_dict)
+    The positional parameters keep their original order; options added since are
+    keyword-only.
+
+    Returns (out_r1_path, out_r2_path, stats_dict). stats_dict["total_sam_records"] counts
+    every SAM record minimap2 wrote; with mm2_hits_only, unmapped reads are left out of its
+    output (--sam-hit-only), so it counts alignment records only.
     """
     start_t = time.time()
 
@@ -92,165 +765,115 @@ def run_filter(
 
     threads = threads or (os.cpu_count() or 1)
 
-    # Prepare temp SAM path
-    cleanup_tmpdir = False
-    if tmp_dir is None:
-        tmp_dir = tempfile.mkdtemp(prefix="vrr_")
-        cleanup_tmpdir = True
-    os.makedirs(tmp_dir, exist_ok=True)
-    sam_path = os.path.join(tmp_dir, "minimap2_out.sam")
-
-    try:
-        # Run minimap2 to produce SAM
-        _run_minimap2(
-            r1_path=r1_path,
-            r2_path=r2_path,
-            ref_fasta=ref_fasta,
-            threads=threads,
-            minimap2=minimap2,
-            extra_mm2_args=extra_mm2_args,
-            sam_out_path=sam_path,
-            logger=logger,
-        )
-
-        # Parse SAM and collect minimal NM per read for R1 and R2
-        min_nm_r1: Dict[str, int] = {}
-        min_nm_r2: Dict[str, int] = {}
-        primary_counts: Counter[str] = Counter()
-        total_sam_records = 0
-        with pysam.AlignmentFile(sam_path, "r") as sam:
-            for aln in sam:
-                total_sam_records += 1
-                if aln.is_unmapped:
-                    continue
-                if not aln.is_secondary and not aln.is_supplementary:
-                    ref_name = aln.reference_name
-                    if ref_name:
-                        primary_counts[ref_name] += 1
-                try:
-                    nm = aln.get_tag("NM")
-                except KeyError:
-                    # No NM tag present; skip from drop consideration
-                    continue
-                name = aln.query_name
-                if aln.is_read1:
-                    prev = min_nm_r1.get(name)
-                    if prev is None or nm < prev:
-                        min_nm_r1[name] = nm
-                elif aln.is_read2:
-                    prev = min_nm_r2.get(name)
-                    if prev is None or nm < prev:
-                        min_nm_r2[name] = nm
-                else:
-                    # In rare cases, orientation flags might not indicate read1/read2; ignore
-                    continue
-
-        # Write primary-alignment counts CSV (always emit header for easy parsing)
-        primary_csv_path = f"{out_prefix}_primary_alignments.csv"
-        with open(primary_csv_path, "w", newline="") as csvfile:
-            writer = csv.writer(csvfile)
-            writer.writerow(["reference_name", "primary_alignment_count"])
-            for ref_name, count in sorted(primary_counts.items()):
-                writer.writerow([ref_name, count])
-
-        if primary_counts:
-            logger.info(
-                "Primary alignment counts written to %s (references=%d)",
-                primary_csv_path,
-                len(primary_counts),
+    # BGZF output is gzip output framed by htslib's bgzip; resolve it before aligning
+    bgzip = None
+    if bgzf:
+        bgzip = shutil.which("bgzip")
+        if bgzip is None:
+            raise FileNotFoundError(
+                "BGZF output requires the bgzip executable (htslib). Ensure it is installed and on PATH."
             )
-        else:
-            logger.info(
-                "Primary alignment counts written to %s (no primary alignments detected)",
-                primary_csv_path,
+        gzip_output = True
+
+    # Reuse a prebuilt index across runs instead of re-indexing the FASTA every time
+    mm2_ref = ref_fasta
+    if cache_index:
+        mm2_ref = _cached_index(ref_fasta, minimap2, extra_mm2_args, threads, logger)
+
+    # minimap2 output is streamed; tmp_dir only hosts the length-sorted copies of the
+    # inputs made for sort_by_length.
+    # Gzipped inputs are decompressed by igzip/pigz children when available, keeping
+    # zlib off minimap2's and our own reader threads
+    decompressor = _find_gzip_decompressor()
+    with contextlib.ExitStack() as stack:
+        mm2_inputs: Sequence[str] = (r1_path, r2_path)
+        if sort_by_length:
+            # Longest pairs first so minimap2's last mini-batches are its cheapest
+            if tmp_dir:
+                os.makedirs(tmp_dir, exist_ok=True)
+            work_dir = stack.enter_context(tempfile.TemporaryDirectory(prefix="vrr_", dir=tmp_dir))
+            mm2_inputs = _sort_pairs_by_length(r1_path, r2_path, decompressor, work_dir, logger)
+        (mm2_r1, mm2_r2), pipes = _open_inputs(stack, mm2_inputs, decompressor)
+        sam_stream = stack.enter_context(
+            _run_minimap2(
+                r1_path=mm2_r1,
+                r2_path=mm2_r2,
+                ref_fasta=mm2_ref,
+                threads=threads,
+                minimap2=minimap2,
+                extra_mm2_args=extra_mm2_args,
+                logger=logger,
+                pass_fds=[pipe.fileno() for pipe in pipes],
+                secondary=mm2_secondary,
+                batch_size=mm2_batch_size,
+                hits_only=mm2_hits_only,
             )
-
-        drop_r1 = {n for n, nm in min_nm_r1.items() if nm <= nm_threshold}
-        drop_r2 = {n for n, nm in min_nm_r2.items() if nm <= nm_threshold}
-
+        )
+        # minimap2 holds its own copies; dropping ours lets a decompressor see EOF/SIGPIPE
+        # if minimap2 exits early
+        for pipe in pipes:
+            pipe.close()
+
+        # The SAM stream is parsed as minimap2 produces it
+        drop_any, primary_counts, total_sam_records = _scan_sam(sam_stream, nm_threshold)
+
+    # Write primary-alignment counts CSV (always emit header for easy parsing)
+    primary_csv_path = f"{out_prefix}_primary_alignments.csv"
+    with open(primary_csv_path, "w", newline="") as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(["reference_name", "primary_alignment_count"])
+        for ref_name, count in sorted(primary_counts.items()):
+            writer.writerow([ref_name, count])
+
+    if primary_counts:
         logger.info(
-            "Collected NM: R1 candidates=%d, R2 candidates=%d; drop<=%d -> R1=%d, R2=%d",
-            len(min_nm_r1), len(min_nm_r2), nm_threshold, len(drop_r1), len(drop_r2)
+            "Primary alignment counts written to %s (references=%d)",
+            primary_csv_path,
+            len(primary_counts),
+        )
+    else:
+        logger.info(
+            "Primary alignment counts written to %s (no primary alignments detected)",
+            primary_csv_path,
         )
 
-        # Prepare outputs (default: uncompressed .fastq; if gzip_output -> .fastq.gz)
-        if gzip_output:
-            out_r1 = f"{out_prefix}_R1.fastq.gz"
-            out_r2 = f"{out_prefix}_R2.fastq.gz"
-        else:
-            out_r1 = f"{out_prefix}_R1.fastq"
-            out_r2 = f"{out_prefix}_R2.fastq"
-
-        total_pairs = 0
-        kept_pairs = 0
-        dropped_pairs = 0
-
-        with contextlib.ExitStack() as stack:
-            fh1 = stack.enter_context(pysam.FastxFile(r1_path))
-            fh2 = stack.enter_context(pysam.FastxFile(r2_path))
-            if gzip_output:
-                w1 = stack.enter_context(gzip.open(out_r1, "wt", compresslevel=gzip_level))
-                w2 = stack.enter_context(gzip.open(out_r2, "wt", compresslevel=gzip_level))
-            else:
-                w1 = stack.enter_context(open(out_r1, "w"))
-                w2 = stack.enter_context(open(out_r2, "w"))
-
-            for rec1, rec2 in zip(fh1, fh2):
-                total_pairs += 1
-                name1 = rec1.name
-                name2 = rec2.name
-
-                # Keep only if both mates are NOT in drop sets
-                # (i.e., drop the pair if either mate aligns within the NM threshold)
-                keep = (name1 not in drop_r1) and (name2 not in drop_r2)
-
-                if keep:
-                    kept_pairs += 1
-                    # Write R1
-                    if rec1.comment:
-                        header1 = f"@{rec1.name} {rec1.comment}\n"
-                    else:
-                        header1 = f"@{rec1.name}\n"
-                    w1.write(header1)
-                    w1.write(f"{rec1.sequence}\n+\n{rec1.quality}\n")
-
-                    # Write R2
-                    if rec2.comment:
-                        header2 = f"@{rec2.name} {rec2.comment}\n"
-                    else:
-                        header2 = f"@{rec2.name}\n"
-                    w2.write(header2)
-                    w2.write(f"{rec2.sequence}\n+\n{rec2.quality}\n")
-                else:
-                    dropped_pairs += 1
-
-        stats: StatsDict = {
-            "total_pairs": total_pairs,
-            "kept_pairs": kept_pairs,
-            "dropped_pairs": dropped_pairs,
-            "nm_threshold": nm_threshold,
-            "threads": threads,
-            "total_sam_records": total_sam_records,
-            "runtime_sec": round(time.time() - start_t, 3),
-            "primary_alignment_csv": primary_csv_path,
-        }
-
-        return out_r1, out_r2, stats
+    logger.info(
+        "Collected NM: drop<=%d -> read names=%d",
+        nm_threshold, len(drop_any)
+    )
+
+    # Prepare outputs (default: uncompressed .fastq; if gzip_output -> .fastq.gz)
+    if gzip_output:
+        out_r1 = f"{out_prefix}_R1.fastq.gz"
+        out_r2 = f"{out_prefix}_R2.fastq.gz"
+    else:
+        out_r1 = f"{out_prefix}_R1.fastq"
+        out_r2 = f"{out_prefix}_R2.fastq"
+
+    with contextlib.ExitStack() as stack:
+        fh1 = _open_fastq(stack, r1_path, decompressor)
+        fh2 = _open_fastq(stack, r2_path, decompressor)
+        # minimap2 has finished by now, so its cores are split between the two outputs
+        compress_threads = max(1, threads // 2)
+        w1 = stack.enter_context(
+            _open_output(out_r1, gzip_output, gzip_level, compress_threads, bgzip)
+        )
+        w2 = stack.enter_context(
+            _open_output(out_r2, gzip_output, gzip_level, compress_threads, bgzip)
+        )
 
-    finally:
-        # Cleanup temp dir if we created it
-        try:
-            if cleanup_tmpdir and os.path.isdir(tmp_dir):
-                # Remove created files
-                for fname in os.listdir(tmp_dir):
-                    try:
-                        os.remove(os.path.join(tmp_dir, fname))
-                    except OSError:
-                        pass
-                try:
-                    os.rmdir(tmp_dir)
-                except OSError:
-                    pass
-        except Exception:
-            # Best-effort cleanup only
-            pass
+        total_pairs, kept_pairs = _filter_pairs(fh1, fh2, drop_any, w1, w2, logger)
+    dropped_pairs = total_pairs - kept_pairs
+
+    stats: StatsDict = {
+        "total_pairs": total_pairs,
+        "kept_pairs": kept_pairs,
+        "dropped_pairs": dropped_pairs,
+        "nm_threshold": nm_threshold,
+        "threads": threads,
+        "total_sam_records": total_sam_records,
+        "runtime_sec": round(time.time() - start_t, 3),
+        "primary_alignment_csv": primary_csv_path,
+    }
+
+    return out_r1, out_r2, stats